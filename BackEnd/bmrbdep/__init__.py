@@ -3,33 +3,59 @@
 import datetime
 import logging
 import os
-import socket
 import tempfile
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import SMTPHandler
-from typing import Dict, Union, Any, Optional, List
+from smtplib import SMTPException
+from typing import Dict, Union, Any, Optional, List, Tuple
 from uuid import uuid4
 
+import orjson
 import pynmrstar
 import requests
-import simplejson as json
 import werkzeug.exceptions
+from cachetools import TTLCache
 from dns.exception import Timeout
 from dns.resolver import NXDOMAIN
 from flask import Flask, request, jsonify, url_for, redirect, send_file, send_from_directory, Response
+from flask.json.provider import JSONProvider
 from flask_mail import Mail, Message
 from itsdangerous import URLSafeSerializer
 from itsdangerous.exc import BadData
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from validate_email import validate_email
 from werkzeug.datastructures import FileStorage
 
 from bmrbdep import depositions
-from bmrbdep.common import configuration, get_schema, root_dir, secure_filename, get_release
+from bmrbdep.common import configuration, get_cached_schema, get_cached_json_schema, get_default_values, root_dir, \
+    secure_filename, get_release
 from bmrbdep.depositions import DepositionRepo
 from bmrbdep.exceptions import ServerError, RequestError
 from bmrbdep.helpers.star_tools import merge_entries
 
+
+class OrjsonProvider(JSONProvider):
+    """ Serializes JSON responses with orjson rather than the standard library. """
+
+    option: int = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        # orjson already produces UTF-8 bytes, so skip the str round trip that dumps() requires
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype='application/json')
+
+
 application = Flask(__name__)
+application.json = OrjsonProvider(application)
 
 # Set debug if running from command line
 if application.debug or configuration['debug']:
@@ -73,6 +99,37 @@ else:
 
     mail = MockMail()
 
+# E-mails are sent from a background thread so that SMTP latency doesn't hold up the request
+mail_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='bmrbdep-mail')
+
+
+def _send_mail_with_retry(message: Message, attempt: int = 1, attempts: int = 3) -> None:
+    """ Sends an e-mail. If the SMTP server can't be reached the send is retried with an increasing delay, without
+    holding a mail worker while waiting. Failures are logged through the application logger, so they reach the admins.
+    Queued and pending e-mails only live in this process, and are lost if the worker exits before sending them. """
+
+    with application.app_context():
+        try:
+            mail.send(message)
+        except (SMTPException, OSError):
+            if attempt == attempts:
+                application.logger.exception('Could not send e-mail "%s" to %s.', message.subject,
+                                             message.recipients)
+                return
+            retry = threading.Timer(2 ** attempt, mail_executor.submit,
+                                    (_send_mail_with_retry, message, attempt + 1, attempts))
+            retry.daemon = True
+            retry.start()
+        except Exception:
+            application.logger.exception('Could not send e-mail "%s" to %s.', message.subject, message.recipients)
+
+
+def send_mail_async(message: Message) -> None:
+    """ Queues an e-mail to be sent without blocking the current request. """
+
+    mail_executor.submit(_send_mail_with_retry, message)
+
+
 # Set up the logger
 if configuration['debug']:
     logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s')
@@ -81,6 +138,80 @@ else:
     logging.getLogger().setLevel('WARNING')
 
 
+# uWSGI runs several request threads per worker, and the TTL caches below are not thread safe on their own
+_cache_lock = threading.Lock()
+
+# Domains which recently passed the mail server check, so repeat depositors skip the DNS and SMTP lookups
+_mail_server_domains: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+
+
+def _has_mail_server(email: str) -> bool:
+    """ Checks that the domain of the e-mail has a reachable mail server. Only successes are cached. """
+
+    domain: str = email[email.index("@") + 1:]
+    with _cache_lock:
+        if _mail_server_domains.get(domain):
+            return True
+    if validate_email(email, check_mx=True, smtp_timeout=3):
+        with _cache_lock:
+            _mail_server_domains[domain] = True
+        return True
+    return False
+
+
+# A shared session keeps the connection to the ORCID API alive between depositions
+orcid_session = requests.Session()
+orcid_session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32,
+                                            max_retries=Retry(total=2, backoff_factor=0.2)))
+_orcid_names: TTLCache = TTLCache(maxsize=1024, ttl=86400)
+
+
+def _get_orcid_names(orcid: str) -> Tuple[Optional[str], Optional[str]]:
+    """ Returns the (given name, family name) registered for an ORCID. """
+
+    with _cache_lock:
+        cached_names: Optional[Tuple[Optional[str], Optional[str]]] = _orcid_names.get(orcid)
+    if cached_names is not None:
+        return cached_names
+
+    try:
+        r = orcid_session.get(configuration['orcid']['url'] % orcid,
+                              headers={"Accept": "application/json",
+                                       'Authorization': 'Bearer %s' % configuration['orcid']['bearer']},
+                              timeout=(3.05, 5))
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        raise ServerError('An error occurred while contacting the ORCID server.')
+    if not r.ok:
+        if r.status_code == 404:
+            raise RequestError('Invalid ORCID!')
+        else:
+            raise ServerError('An error occurred while contacting the ORCID server.')
+
+    orcid_json = r.json()
+    try:
+        author_given = orcid_json['person']['name']['given-names']['value']
+    except (TypeError, KeyError):
+        author_given = None
+    try:
+        author_family = orcid_json['person']['name']['family-name']['value']
+    except (TypeError, KeyError):
+        author_family = None
+
+    with _cache_lock:
+        _orcid_names[orcid] = (author_given, author_family)
+    return author_given, author_family
+
+
+# The only request headers worth keeping in the deposition metadata
+_AUDIT_HEADERS: Tuple[str, ...] = ('User-Agent', 'X-Forwarded-For', 'Accept-Language', 'Referer')
+
+
+def _audit_headers() -> Dict[str, str]:
+    """ Returns the audit-relevant headers of the current request. """
+
+    return {header: request.headers[header] for header in _AUDIT_HEADERS if request.headers.get(header)}
+
+
 # Set up error handling
 @application.errorhandler(ServerError)
 @application.errorhandler(RequestError)
@@ -144,91 +275,65 @@ def handle_other_errors(exception: Exception):
         return response
 
 
+# The location of the built Angular files, resolved on first use
+_angular_path: Optional[str] = None
+
+
 @application.route('/')
 @application.route('/<path:filename>', methods=['GET'])
 def send_local_file(filename: str = None) -> Response:
+    global _angular_path
+
     if filename is None:
         filename = "index.html"
 
-    angular_path: str = os.path.join(root_dir, '..', '..', 'FrontEnd', 'dist')
-    if not os.path.exists(angular_path):
-        angular_path = os.path.join(root_dir, '..', 'dist')
-    if not os.path.exists(angular_path):
-        return Response('Broken installation. The Angular HTML/JS/CSS files are missing from the docker container. ')
-
-    if not os.path.exists(os.path.join(angular_path, filename)):
-        filename = 'index.html'
+    if _angular_path is None:
+        for candidate_path in [os.path.join(root_dir, '..', '..', 'FrontEnd', 'dist'),
+                               os.path.join(root_dir, '..', 'dist')]:
+            if os.path.exists(candidate_path):
+                _angular_path = candidate_path
+                break
+        else:
+            return Response('Broken installation. The Angular HTML/JS/CSS files are missing from the docker '
+                            'container. ')
 
-    return send_from_directory(directory=angular_path, path=filename)
+    # Any path that isn't a file is an Angular route, so serve the application
+    try:
+        return send_from_directory(directory=_angular_path, path=filename)
+    except werkzeug.exceptions.NotFound:
+        return send_from_directory(directory=_angular_path, path='index.html')
 
 
 @application.route('/deposition/<uuid:uuid>/check-valid')
 def send_validation_status(uuid) -> Response:
     """ Returns whether or not an entry has been validated. """
 
-    with depositions.DepositionRepo(str(uuid)) as repo:
+    with depositions.DepositionRepo(uuid) as repo:
         return jsonify({'status': repo.metadata['email_validated'],
                         'commit': repo.last_commit})
 
 
-@application.route('/deposition/<uuid:uuid>/resend-validation-email')
-def send_validation_email(uuid, repo_object: Optional[DepositionRepo] = None) -> Response:
-    """ Sends the validation e-mail. """
-
-    uuid = str(uuid)
-
-    if not repo_object:
-        repo_object = depositions.DepositionRepo(uuid)
-
-    with repo_object as repo:
-        # Already validated, don't re-send the email
-        if repo.metadata['email_validated']:
-            # Ask them to confirm their e-mail
-            confirm_message = Message("Entry reference for BMRBDep deposition '%s'." %
-                                      repo.metadata['deposition_nickname'],
-                                      recipients=[repo.metadata['author_email']],
-                                      reply_to=configuration['smtp']['reply_to_address'])
-            token = URLSafeSerializer(configuration['secret_key']).dumps({'deposition_id': uuid})
-
-            confirm_message.html = """
-            Thank you for your deposition '%s' created %s (UTC).
-            <br><br>
-            To return to this deposition, click <a href="%s" target="BMRBDep">here</a>.
-            <br><br>
-            If you wish to share access with collaborators, simply forward them this e-mail. Be aware that anyone you
-            share this e-mail with will have access to the full contents of your in-progress deposition and can make
-            changes to it.
-
-            If you are using a shared computer, please ensure that you click the "End Session" button in the left panel menu when
-            leaving the computer. (You can always return to it using the link above.) If you fail to do so, others who use your
-            computer could access your in-process deposition.
-            <br><br>
-            Thank you,
-            <br>
-            BMRBDep System""" % (repo.metadata['deposition_nickname'], repo.metadata['creation_date'],
-                                 url_for('validate_user', token=token, _external=True))
-
-            try:
-                mail.send(confirm_message)
-            except socket.gaierror:
-                if configuration['debug']:
-                    logging.warning('Invalid SMTP server configured!')
-                else:
-                    raise ServerError('Server is mis-configured, please contact the administrator.')
-            return jsonify({'status': 'validated'})
-
-
-        # Ask them to confirm their e-mail
-        confirm_message = Message("Please validate your e-mail address for BMRBdep deposition '%s'." %
-                                  repo.metadata['deposition_nickname'],
-                                  recipients=[repo.metadata['author_email']],
-                                  reply_to=configuration['smtp']['reply_to_address'])
-        token = URLSafeSerializer(configuration['secret_key']).dumps({'deposition_id': uuid})
+# The e-mail templates are compiled once, when the module loads
+_reference_email_template = application.jinja_env.from_string("""
+Thank you for your deposition '{{ nickname }}' created {{ creation_date }} (UTC).
+<br><br>
+To return to this deposition, click <a href="{{ url }}" target="BMRBDep">here</a>.
+<br><br>
+If you wish to share access with collaborators, simply forward them this e-mail. Be aware that anyone you
+share this e-mail with will have access to the full contents of your in-progress deposition and can make
+changes to it.
 
-        confirm_message.html = """
-Thank you for your deposition '%s' created %s (UTC).
+If you are using a shared computer, please ensure that you click the "End Session" button in the left panel menu when
+leaving the computer. (You can always return to it using the link above.) If you fail to do so, others who use your
+computer could access your in-process deposition.
 <br><br>
-Please click <a href="%s" target="BMRBDep">here</a> to validate your e-mail for this session. This is required to 
+Thank you,
+<br>
+BMRBDep System""")
+_validation_email_template = application.jinja_env.from_string("""
+Thank you for your deposition '{{ nickname }}' created {{ creation_date }} (UTC).
+<br><br>
+Please click <a href="{{ url }}" target="BMRBDep">here</a> to validate your e-mail for this session. This is required to
 proceed. You can also use this link to return to your deposition later if you close the page before
 it is complete.
 <br><br>
@@ -242,10 +347,43 @@ computer could access your in-process deposition.
 <br><br>
 Thank you,
 <br>
-BMRBDep System""" % (repo.metadata['deposition_nickname'], repo.metadata['creation_date'],
-                     url_for('validate_user', token=token, _external=True))
+BMRBDep System""")
 
-        mail.send(confirm_message)
+
+@application.route('/deposition/<uuid:uuid>/resend-validation-email')
+def send_validation_email(uuid) -> Response:
+    """ Sends the validation e-mail. """
+
+    with depositions.DepositionRepo(uuid) as repo:
+        return _send_validation_email(str(uuid), repo)
+
+
+def _send_validation_email(uuid: str, repo: DepositionRepo) -> Response:
+    """ Sends the validation e-mail using a repo which is already open. """
+
+    token = URLSafeSerializer(configuration['secret_key']).dumps({'deposition_id': uuid})
+    template_values = {'nickname': repo.metadata['deposition_nickname'],
+                       'creation_date': repo.metadata['creation_date'],
+                       'url': url_for('validate_user', token=token, _external=True)}
+
+    # Already validated, don't re-send the email
+    if repo.metadata['email_validated']:
+        # Send them a link to return to the deposition
+        confirm_message = Message("Entry reference for BMRBDep deposition '%s'." %
+                                  repo.metadata['deposition_nickname'],
+                                  recipients=[repo.metadata['author_email']],
+                                  reply_to=configuration['smtp']['reply_to_address'])
+        confirm_message.html = _reference_email_template.render(**template_values)
+        send_mail_async(confirm_message)
+        return jsonify({'status': 'validated'})
+
+    # Ask them to confirm their e-mail
+    confirm_message = Message("Please validate your e-mail address for BMRBdep deposition '%s'." %
+                              repo.metadata['deposition_nickname'],
+                              recipients=[repo.metadata['author_email']],
+                              reply_to=configuration['smtp']['reply_to_address'])
+    confirm_message.html = _validation_email_template.render(**template_values)
+    send_mail_async(confirm_message)
 
     return jsonify({'status': 'unvalidated'})
 
@@ -280,8 +418,7 @@ def duplicate_deposition(uuid) -> Response:
     schema_name = configuration['schema_version']
     if request_info.get('deposition_type', 'macromolecule') == "small molecule":
         schema_name += "-sm"
-    schema: pynmrstar.Schema = pynmrstar.Schema(get_schema(schema_name, schema_format='xml'))
-    json_schema: dict = get_schema(schema_name)
+    schema, _, json_schema_bytes = get_cached_schema(schema_name)
     entry_template: pynmrstar.Entry = pynmrstar.Entry.from_template(entry_id=deposition_id, all_tags=True,
                                                                     default_values=True, schema=schema)
 
@@ -300,7 +437,7 @@ def duplicate_deposition(uuid) -> Response:
                                        'author_email': repo.metadata['author_email'],
                                        'author_orcid': repo.metadata['author_orcid'],
                                        'last_ip': request.environ['REMOTE_ADDR'],
-                                       'deposition_origination': {'request': dict(request.headers),
+                                       'deposition_origination': {'request': _audit_headers(),
                                                                   'ip': request.environ['REMOTE_ADDR']},
                                        'email_validated': repo.metadata['email_validated'],
                                        'schema_version': schema.version,
@@ -312,12 +449,12 @@ def duplicate_deposition(uuid) -> Response:
                                        'deposition_cloned_from': str(uuid)
                                        }
             new_repo.write_entry(entry_template)
-            new_repo.write_file('schema.json', data=json.dumps(json_schema).encode(), root=True)
+            new_repo.write_file('schema.json', data=json_schema_bytes, root=True)
             # Delete data files when cloning
             for file_ in new_repo.get_data_file_list():
                 new_repo.delete_data_file(file_)
             new_repo.commit('Creating new deposition from existing deposition %s' % uuid)
-            send_validation_email(deposition_id, new_repo)
+            _send_validation_email(deposition_id, new_repo)
 
     return jsonify({'deposition_id': deposition_id})
 
@@ -342,7 +479,7 @@ def new_deposition() -> Response:
     entry_bootstrap: bool = False
     if 'nmrstar_file' in request.files and request.files['nmrstar_file'] and request.files['nmrstar_file'].filename:
         try:
-            uploaded_entry = pynmrstar.Entry.from_string(request.files['nmrstar_file'].read().decode())
+            uploaded_entry = pynmrstar.Entry.from_string(request.files['nmrstar_file'].stream.read().decode())
         except pynmrstar.exceptions.ParsingError as e:
             raise RequestError("Invalid NMR-STAR file: %s" % repr(e))
         except UnicodeDecodeError:
@@ -368,7 +505,7 @@ def new_deposition() -> Response:
             if not validate_email(author_email):
                 raise RequestError("The e-mail you provided is not a valid e-mail. Please check the e-mail you "
                                    "provided for typos.")
-            elif not validate_email(author_email, check_mx=True, smtp_timeout=3):
+            elif not _has_mail_server(author_email):
                 raise RequestError("The e-mail you provided is invalid. There is no e-mail server at '%s'. (Do you "
                                    "have a typo in the part of your e-mail after the @?) If you are certain"
                                    " that your e-mail is correct, please select the 'My e-mail is correct' checkbox "
@@ -388,8 +525,7 @@ def new_deposition() -> Response:
     schema_name = configuration['schema_version']
     if request_info.get('deposition_type', 'macromolecule') == "small molecule":
         schema_name += "-sm"
-    schema: pynmrstar.Schema = pynmrstar.Schema(get_schema(schema_name, schema_format='xml'))
-    json_schema: dict = get_schema(schema_name)
+    schema, json_schema, json_schema_bytes = get_cached_schema(schema_name)
     entry_template: pynmrstar.Entry = pynmrstar.Entry.from_template(entry_id=deposition_id, all_tags=True,
                                                                     default_values=True, schema=schema)
 
@@ -430,6 +566,8 @@ def new_deposition() -> Response:
         data_file_loop.add_missing_tags(all_tags=True, schema=schema)
         entry_template.get_saveframes_by_category('deposited_data_files')[0]['_Upload_data'] = data_file_loop
 
+    # This can't be skipped even when nothing was uploaded - besides sorting, normalize() assigns the ID tags and
+    #  updates the links to them, which a fresh template doesn't have yet
     entry_template.normalize(schema=schema)
 
     # Set the entry information tags
@@ -447,56 +585,41 @@ def new_deposition() -> Response:
 
     # Just add a single row to the entry author loop
     author_loop: pynmrstar.Loop = entry_saveframe['_Entry_author']
-    author_loop.data.insert(0, ['.'] * len(author_loop.tags))
+    author_loop.data = [['.'] * len(author_loop.tags), *author_loop.data]
 
     # Modify the contact_loop as needed
     contact_loop: pynmrstar.Loop = entry_saveframe['_Contact_person']
 
     # Make sure that whoever started the deposition is locked as the first contact person
+    contact_rows: List[List[Any]] = contact_loop.data
     contact_emails: List[str] = contact_loop.get_tag('email_address')
     if author_email in contact_emails:
         # They are already there, move their data to the first row and update it if necessary
-        contact_loop.data.insert(0, contact_loop.data.pop(contact_emails.index(author_email)))
+        primary_row: List[Any] = contact_rows.pop(contact_emails.index(author_email))
     else:
         # They are not yet present in the contact persons
-        contact_loop.data.insert(0, ['.'] * len(contact_loop.tags))
-        contact_loop.data[0][contact_loop.tag_index('Email_address')] = author_email
+        primary_row = ['.'] * len(contact_loop.tags)
+        primary_row[contact_loop.tag_index('Email_address')] = author_email
+    contact_rows = [primary_row, *contact_rows]
     # Need to be 2 contact authors
-    if len(contact_loop.data) < 2:
-        contact_loop.data.append(['.'] * len(contact_loop.tags))
-    contact_loop.renumber_rows('ID')
+    if len(contact_rows) < 2:
+        contact_rows.append(['.'] * len(contact_loop.tags))
 
     # Look up information based on the ORCID
     if author_orcid:
-        contact_loop.data[0][contact_loop.tag_index('ORCID')] = author_orcid
+        primary_row[contact_loop.tag_index('ORCID')] = author_orcid
         if 'orcid' not in configuration or configuration['orcid']['bearer'] == 'CHANGEME':
             logging.warning('Please specify your ORCID API credentials, or else auto-filling from ORCID will fail.')
         else:
-            try:
-                r = requests.get(configuration['orcid']['url'] % author_orcid,
-                                 headers={"Accept": "application/json",
-                                          'Authorization': 'Bearer %s' % configuration['orcid']['bearer']})
-            except (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout):
-                raise ServerError('An error occurred while contacting the ORCID server.')
-            if not r.ok:
-                if r.status_code == 404:
-                    raise RequestError('Invalid ORCID!')
-                else:
-                    raise ServerError('An error occurred while contacting the ORCID server.')
-            else:
-                orcid_json = r.json()
-                try:
-                    author_given = orcid_json['person']['name']['given-names']['value']
-                except (TypeError, KeyError):
-                    author_given = None
-                try:
-                    author_family = orcid_json['person']['name']['family-name']['value']
-                except (TypeError, KeyError):
-                    author_family = None
-                contact_loop.data[0][contact_loop.tag_index('Given_name')] = author_given
-                contact_loop.data[0][contact_loop.tag_index('Family_name')] = author_family
+            author_given, author_family = _get_orcid_names(author_orcid)
+            primary_row[contact_loop.tag_index('Given_name')] = author_given
+            primary_row[contact_loop.tag_index('Family_name')] = author_family
+
+    contact_loop.data = contact_rows
+    contact_loop.renumber_rows('ID')
 
     # Set the loops to have at least one row of data
+    default_values: Dict[str, Any] = get_default_values(schema_name)
     for saveframe in entry_template:
 
         # Add a "deleted" tag to use to track deletion status
@@ -504,39 +627,39 @@ def new_deposition() -> Response:
 
         for loop in saveframe:
             if not loop.data:
-                loop.data = []
-
                 iterations: int = 1
                 if "Experiment_ID" in loop.tags or loop.category == '_Sample_component':
                     iterations = 3
 
+                category: str = loop.category + '.'
+                default_row: list = [None if tag == "ID" else default_values[(category + tag).lower()]
+                                     for tag in loop.tags]
+                id_positions: List[int] = [pos for pos, tag in enumerate(loop.tags) if tag == "ID"]
+
+                loop.data = []
                 for x in range(1, iterations + 1):
-                    row_data = []
-                    for tag in loop.tags:
-                        fqtn = (loop.category + '.' + tag).lower()
-                        if tag == "ID":
-                            row_data.append(x)
-                        elif schema.schema[fqtn]['default value'] not in ["?", '']:
-                            row_data.append(schema.schema[fqtn]['default value'])
-                        else:
-                            row_data.append('.')
+                    row_data = default_row.copy()
+                    for pos in id_positions:
+                        row_data[pos] = x
                     loop.data.append(row_data)
 
     # Set the entry_interview tags
     entry_interview: pynmrstar.Saveframe = entry_template.get_saveframes_by_category('entry_interview')[0]
-    for tag in json_schema['file_upload_types']:
-        entry_interview[tag[2]] = "no"
-    entry_interview['PDB_deposition'] = "no"
-    entry_interview['BMRB_deposition'] = "yes"
+    # Collect the values first, so that each tag is set only once even when several upload types share it
+    interview_tags: Dict[str, str] = {tag[2]: "no" for tag in json_schema['file_upload_types']}
+    interview_tags['PDB_deposition'] = "no"
+    interview_tags['BMRB_deposition'] = "yes"
     # Set the tag to store that this entry was bootstrapped
     if entry_bootstrap:
-        entry_interview['Previous_BMRB_entry_used'] = request_info['bootstrapID']
+        interview_tags['Previous_BMRB_entry_used'] = request_info['bootstrapID']
+    for tag_name, tag_value in interview_tags.items():
+        entry_interview.add_tag(tag_name, tag_value, update=True)
 
     entry_meta: dict = {'deposition_id': deposition_id,
                         'author_email': author_email,
                         'author_orcid': author_orcid,
                         'last_ip': request.environ['REMOTE_ADDR'],
-                        'deposition_origination': {'request': dict(request.headers),
+                        'deposition_origination': {'request': _audit_headers(),
                                                    'ip': request.environ['REMOTE_ADDR']},
                         'email_validated': configuration['debug'],
                         'schema_version': schema.version,
@@ -551,20 +674,20 @@ def new_deposition() -> Response:
         # Manually set the metadata during object creation - never should be done this way elsewhere
         repo._live_metadata = entry_meta
         repo.write_entry(entry_template)
-        repo.write_file('schema.json', data=json.dumps(json_schema).encode(), root=True)
+        repo.write_file('schema.json', data=json_schema_bytes, root=True)
         if uploaded_entry:
             if entry_bootstrap:
                 entry_meta['bootstrap_entry'] = request_info['bootstrapID']
                 repo.write_file('bootstrap_entry.str', data=str(uploaded_entry).encode(), root=True)
             else:
-                request.files['nmrstar_file'].seek(0)
-                repo.write_file('bootstrap_entry.str', data=request.files['nmrstar_file'].read(), root=True)
+                request.files['nmrstar_file'].stream.seek(0)
+                repo.write_file('bootstrap_entry.str', source_file=request.files['nmrstar_file'].stream, root=True)
                 entry_meta['bootstrap_filename'] = repo.write_file(request.files['nmrstar_file'].filename,
                                                                    data=str(uploaded_entry).encode())
         repo.commit("Entry created.")
 
         # Send the validation e-mail
-        send_validation_email(deposition_id, repo)
+        _send_validation_email(deposition_id, repo)
 
     return jsonify({'deposition_id': deposition_id})
 
@@ -581,10 +704,10 @@ def deposit_entry(uuid) -> Response:
         bmrb_num = repo.deposit(final_entry)
 
         # Send out the e-mails
-        contact_emails: List[str] = final_entry.get_loops_by_category("_Contact_Person")[0].get_tag(['Email_address'])
+        contact_loop: pynmrstar.Loop = final_entry.get_loops_by_category("_Contact_Person")[0]
+        contact_emails: List[str] = contact_loop.get_tag(['Email_address'])
         contact_full = ["%s %s <%s>" % tuple(x) for x in
-                        final_entry.get_loops_by_category("_Contact_Person")[0].get_tag(
-                            ['Given_name', 'Family_name', 'Email_address'])]
+                        contact_loop.get_tag(['Given_name', 'Family_name', 'Email_address'])]
         message = Message("Your entry has been deposited!", recipients=contact_emails,
                           reply_to=configuration['smtp']['reply_to_address'])
         message.html = 'Thank you for your deposition! Your assigned BMRB ID is %s. We have attached a copy of the ' \
@@ -593,8 +716,10 @@ def deposit_entry(uuid) -> Response:
                        'you uploaded will be manually integrated into the final NMR-STAR file by the BMRB annotators ' \
                        '- their contents are not included in the NMR-STAR file attached to this e-mail.<br><br>' \
                        'Deposited data files: %s' % (bmrb_num, repo.get_data_file_list())
-        message.attach("%s.str" % uuid, "text/plain", str(final_entry))
-        mail.send(message)
+        # Attach the copy written to disk during deposition rather than formatting the entry a second time
+        with repo.get_file('deposition.str') as deposited_entry:
+            message.attach("%s.str" % uuid, "text/plain", deposited_entry.read())
+        send_mail_async(message)
 
         # Send a message to the annotators
         if not configuration['debug']:
@@ -612,7 +737,7 @@ title: %s
 
 contact persons: %s
 ''' % (uuid, bmrb_num, final_entry['entry_information_1']['Title'][0], contact_full)
-        mail.send(message)
+        send_mail_async(message)
 
     return jsonify({'commit': repo.last_commit})
 
@@ -667,16 +792,23 @@ def fetch_or_store_deposition(uuid):
 
     # Store an entry
     if request.method == "PUT":
-        entry_json: dict = request.get_json()
+        # Parse the body directly rather than through request.get_json(), so the raw bytes aren't kept around
+        try:
+            entry_json: dict = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            raise RequestError("Invalid JSON uploaded. The request body was not valid JSON.")
         try:
             entry: pynmrstar.Entry = pynmrstar.Entry.from_json(entry_json)
         except ValueError:
             raise RequestError("Invalid JSON uploaded. The JSON was not a valid NMR-STAR entry.")
 
         with depositions.DepositionRepo(uuid) as repo:
-            existing_entry: pynmrstar.Entry = repo.get_entry()
+            # If they aren't making any changes (checked by digest first, to skip loading the stored entry)
+            entry_digest: str = repo.entry_digest(entry)
+            if repo.entry_unchanged(entry_digest):
+                return jsonify({'commit': repo.last_commit})
 
-            # If they aren't making any changes
+            existing_entry: pynmrstar.Entry = repo.get_entry()
             try:
                 if existing_entry == entry:
                     return jsonify({'commit': repo.last_commit})
@@ -696,7 +828,7 @@ def fetch_or_store_deposition(uuid):
                     return jsonify({'error': 'reload'})
 
             # Update the entry data
-            repo.write_entry(entry)
+            repo.write_entry(entry, digest=entry_digest)
             repo.commit("Entry updated.")
 
             return jsonify({'commit': repo.last_commit})
@@ -713,7 +845,7 @@ def fetch_or_store_deposition(uuid):
             deposition_nickname: str = repo.metadata['deposition_nickname']
             commit: str = repo.last_commit
         try:
-            schema: dict = get_schema(schema_version)
+            schema: dict = get_cached_json_schema(schema_version)[0]
         except RequestError:
             raise ServerError("Entry specifies schema that doesn't exist on the server: %s" % schema_version)
 
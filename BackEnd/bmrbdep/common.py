@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
+import functools
 import os
 import pathlib
+import re
 import zlib
-from typing import Union, TextIO, Tuple, Iterable
+from typing import Union, TextIO, Tuple, Iterable, Dict, Any, cast
 
+import orjson
+import pynmrstar
 import simplejson as json
 import werkzeug.utils
 
@@ -53,16 +57,60 @@ def get_schema(version: str, schema_format: str = "json") -> Union[dict, TextIO]
     return schema
 
 
+@functools.lru_cache(maxsize=16)
+def get_cached_json_schema(version: str) -> Tuple[dict, bytes]:
+    """ Returns the JSON schema, and the JSON schema serialized as bytes, for a schema version. These are loaded from
+    disk once per process and shared between requests, so they must not be modified. """
+
+    json_schema: dict = cast(dict, get_schema(version))
+    return json_schema, orjson.dumps(json_schema)
+
+
+@functools.lru_cache(maxsize=4)
+def get_cached_schema(version: str) -> Tuple[pynmrstar.Schema, dict, bytes]:
+    """ Returns the parsed pynmrstar schema, the JSON schema, and the JSON schema serialized as bytes for a
+    schema version. These are loaded from disk once per process and shared between requests, so they must not
+    be modified. Use get_cached_json_schema() when the pynmrstar schema isn't needed, as parsing it is slow. """
+
+    with cast(TextIO, get_schema(version, schema_format='xml')) as schema_file:
+        schema: pynmrstar.Schema = pynmrstar.Schema(schema_file)
+    json_schema, json_schema_bytes = get_cached_json_schema(version)
+    return schema, json_schema, json_schema_bytes
+
+
+@functools.lru_cache(maxsize=4)
+def get_default_values(version: str) -> Dict[str, Any]:
+    """ Returns the value to use for each (lower case) fully qualified tag in an empty loop row for a schema
+    version. Tags without a default in the schema get '.'. """
+
+    schema: pynmrstar.Schema = get_cached_schema(version)[0]
+    return {fqtn: '.' if tag_schema['default value'] in ("?", '') else tag_schema['default value']
+            for fqtn, tag_schema in schema.schema.items()}
+
+
 def get_release():
     """ Returns the git branch and last commit that were present during the last release. """
 
     return open(os.path.join(root_dir, 'version.txt'), 'r').read().strip()
 
 
+# File names which werkzeug's secure_filename would return unchanged
+_SAFE_FILENAME = re.compile('[A-Za-z0-9-](?:[A-Za-z0-9_.-]*[A-Za-z0-9-])?')
+
+
+@functools.lru_cache(maxsize=4096)
+def _werkzeug_secure_filename(filename: str) -> str:
+    """ Caches werkzeug secure_filename, as the same names are secured over and over. """
+
+    return werkzeug.utils.secure_filename(filename)
+
+
 def secure_filename(filename: str) -> str:
     """ Wraps werkzeug secure_filename but raises an error if the filename comes out empty. """
 
-    filename = werkzeug.utils.secure_filename(filename)
+    if _SAFE_FILENAME.fullmatch(filename):
+        return filename
+    filename = _werkzeug_secure_filename(filename)
     if not filename:
         raise RequestError('Invalid upload file name. Please rename the file and try again.')
     return filename
@@ -1,22 +1,26 @@
 #!/usr/bin/env python3
 
-import json
+import contextlib
+import hashlib
 import logging
 import os
 import pathlib
 import shutil
+import tempfile
 from datetime import date, datetime
-from typing import List, BinaryIO, Optional
+from typing import List, BinaryIO, Iterator, Optional, Set
 
 import flask
+import orjson
 import psycopg2
 import pynmrstar
 import unidecode
 from dateutil.relativedelta import relativedelta
 from filelock import Timeout, FileLock
-from git import Repo, CacheError
+from git import Repo, CacheError, Commit, Tree
 
-from bmrbdep.common import configuration, residue_mappings, get_release, get_schema, secure_full_path
+from bmrbdep.common import configuration, residue_mappings, get_release, get_cached_schema, secure_full_path, \
+    secure_filename
 from bmrbdep.exceptions import ServerError, RequestError
 from bmrbdep.helpers.pubmed import update_citation_with_pubmed
 from bmrbdep.helpers.star_tools import upgrade_chemcomps_and_create_entities_where_needed
@@ -29,6 +33,12 @@ if not os.path.exists(configuration['repo_path']):
         pass
 
 
+# How submission_info.json is serialized
+_METADATA_OPTIONS: int = orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2
+# How many paths to stage per git invocation
+_INDEX_BATCH_SIZE: int = 500
+
+
 class DepositionRepo:
     """ A class to interface with git repos for depositions.
 
@@ -51,12 +61,16 @@ class DepositionRepo:
         self._uuid = uuid
         self._initialize: bool = initialize
         self._read_only: bool = read_only
-        self._modified_files: bool = False
+        # Paths (relative to the entry directory) written or deleted since the last commit
+        self._dirty_paths: Set[str] = set()
         self._live_metadata: dict = {}
-        self._original_metadata: dict = {}
+        # The metadata as loaded from disk (or last written), serialized the way it is written for comparison
+        self._original_metadata: bytes = b''
+        # The UUID may be passed as a string or a UUID object; format it once and derive every path from it
         uuids = str(uuid)
-        self._lock_path: str = os.path.join(configuration['repo_path'], uuids[0], uuids[1], uuids, '.git', 'api.lock')
         self._entry_dir: str = os.path.join(configuration['repo_path'], uuids[0], uuids[1], uuids)
+        self._data_dir: str = os.path.join(self._entry_dir, 'data_files')
+        self._lock_path: str = os.path.join(self._entry_dir, '.git', 'api.lock')
 
         # Make sure the entry ID is valid, or throw an exception
         if not os.path.exists(self._entry_dir):
@@ -64,23 +78,19 @@ class DepositionRepo:
                 raise RequestError('No deposition with that ID exists!', status_code=404)
             else:
                 # Create the entry directory (and parent folders, where needed)
-                first_parent = os.path.join(configuration['repo_path'], uuids[0])
-                if not os.path.exists(first_parent):
-                    os.mkdir(first_parent)
-                second_parent = os.path.join(configuration['repo_path'], uuids[0], uuids[1])
-                if not os.path.exists(second_parent):
-                    os.mkdir(second_parent)
-                os.mkdir(self._entry_dir)
-                os.mkdir(os.path.join(self._entry_dir, '.git'))
-                os.mkdir(os.path.join(self._entry_dir, 'data_files'))
+                os.makedirs(os.path.join(self._entry_dir, '.git'))
+                os.mkdir(self._data_dir)
 
                 self._repo = Repo.init(self._entry_dir)
-                with self._repo.config_writer() as config:
-                    config.set_value("user", "name", "BMRBDep")
-                    config.set_value("user", "email", "help@bmrb.io")
+                # The config was just created by git, so append the user section rather than having GitPython parse
+                #  and rewrite the whole file
+                with open(os.path.join(self._entry_dir, '.git', 'config'), 'a') as config:
+                    config.write('[user]\n\tname = BMRBDep\n\temail = help@bmrb.io\n')
 
-        # Create the lock object
-        self._lock_object: FileLock = FileLock(self._lock_path, timeout=360)
+        # Create the lock object - it is only acquired (once, in __enter__) by sessions that can write
+        self._lock_object: Optional[FileLock] = None
+        if not self._read_only:
+            self._lock_object = FileLock(self._lock_path, timeout=360)
 
         if not self._initialize and not self._read_only:
             self._repo = Repo(self._entry_dir)
@@ -101,9 +111,10 @@ class DepositionRepo:
         """ End the current session."""
 
         if not self._read_only:
-            # If nothing changed the commit won't do anything
             try:
-                self.commit("Repo closed with changes but without a manual commit... Potential software bug.")
+                # Only fall back to committing if something was written since the last commit
+                if self._dirty_paths or self._metadata_changed():
+                    self.commit("Repo closed with changes but without a manual commit... Potential software bug.")
                 self._repo.close()
                 self._repo.__del__()
             # Catches all git-related errors
@@ -112,7 +123,7 @@ class DepositionRepo:
             finally:
                 self._lock_object.release()
         else:
-            if self._live_metadata != self._original_metadata:
+            if self._metadata_changed():
                 raise ServerError("Metadata edited for a deposition that was opened read-only! These changes have not"
                                   " been saved.")
 
@@ -121,10 +132,19 @@ class DepositionRepo:
         """ Return the metadata dictionary. """
 
         if not self._live_metadata:
-            self._live_metadata = json.loads(self.get_file('submission_info.json').read())
-            self._original_metadata = self._live_metadata.copy()
+            with self.get_file('submission_info.json') as metadata_file:
+                self._live_metadata = orjson.loads(metadata_file.read())
+            self._original_metadata = orjson.dumps(self._live_metadata, option=_METADATA_OPTIONS)
         return self._live_metadata
 
+    def _metadata_changed(self) -> bool:
+        """ Checks if the metadata has been modified since it was loaded or last written. Comparing the serialized
+        form also catches changes to nested values. """
+
+        if not self._live_metadata:
+            return False
+        return orjson.dumps(self._live_metadata, option=_METADATA_OPTIONS) != self._original_metadata
+
     @property
     def last_commit(self) -> str:
         if not self._repo:
@@ -137,7 +157,8 @@ class DepositionRepo:
         self.raise_write_errors()
         if not self.metadata['email_validated']:
             raise RequestError('You must validate your e-mail before deposition.')
-        contact_emails: List[str] = final_entry.get_loops_by_category("_Contact_Person")[0].get_tag(['Email_address'])
+        contact_loop: pynmrstar.Loop = final_entry.get_loops_by_category("_Contact_Person")[0]
+        contact_emails: List[str] = contact_loop.get_tag(['Email_address'])
         if self.metadata['author_email'] not in contact_emails:
             raise RequestError('At least one contact person must have the email of the original deposition creator.')
         existing_entry_id = self.get_entry().entry_id
@@ -148,7 +169,7 @@ class DepositionRepo:
         logging.info('Depositing deposition %s' % final_entry.entry_id)
 
         # Determine which schema version the entry is using
-        schema: pynmrstar.Schema = pynmrstar.Schema(get_schema(self.metadata['schema_version'], schema_format='xml'))
+        schema: pynmrstar.Schema = get_cached_schema(self.metadata['schema_version'])[0]
 
         # Add tags stripped by the deposition interface
         final_entry.add_missing_tags(schema=schema)
@@ -290,16 +311,16 @@ class DepositionRepo:
                   'submission_date': today_str,
                   'accession_date': today_str,
                   'last_updated': today_str,
-                  'molecular_system': final_entry['entry_information_1']['Title'][0],
+                  'molecular_system': entry_saveframe['Title'][0],
                   'onhold_status': 'Pub',
                   'restart_id': final_entry.entry_id
                   }
 
         # Dep_release_code_nmr_exptl was wrongly used in place of Release_request in dictionary versions < 3.2.8.1
         try:
-            release_status: str = final_entry['entry_information_1']['Dep_release_code_nmr_exptl'][0].upper()
+            release_status: str = entry_saveframe['Dep_release_code_nmr_exptl'][0].upper()
         except (KeyError, ValueError):
-            release_status = final_entry['entry_information_1']['Release_request'][0].upper()
+            release_status = entry_saveframe['Release_request'][0].upper()
 
         if release_status == 'RELEASE NOW':
             params['onhold_status'] = today_date.strftime("%m/%d/%y")
@@ -316,7 +337,6 @@ class DepositionRepo:
         else:
             raise ServerError('Invalid release code.')
 
-        contact_loop: pynmrstar.Loop = final_entry.get_loops_by_category("_Contact_Person")[0]
         params['author_email'] = ",".join(contact_loop.get_tag(['Email_address']))
         contact_people = [', '.join(x) for x in contact_loop.get_tag(['Family_name', 'Given_name'])]
         params['contact_person1'] = contact_people[0]
@@ -408,34 +428,113 @@ INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
         entry_location = os.path.join(self._entry_dir, 'entry.str')
 
         try:
-            return pynmrstar.Entry.from_file(entry_location)
+            # entry.str is always written uncompressed by write_entry, so parse it directly rather than through
+            #  from_file, which copies the whole file several times while checking for compression
+            with open(entry_location, 'rb') as entry_file:
+                entry_text: str = entry_file.read().decode()
+            # Normalize line endings the same way from_file does, but only copy the text when actually needed
+            if '\r' in entry_text:
+                entry_text = entry_text.replace("\r\n", "\n").replace("\r", "\n")
+            return pynmrstar.Entry.from_string(entry_text)
         except Exception as e:
             raise ServerError('Error loading an entry!\nError: %s\nEntry location:%s' % (repr(e), entry_location))
 
-    def write_entry(self, entry: pynmrstar.Entry) -> None:
-        """ Save an entry in the standard place. """
+    @staticmethod
+    def entry_digest(entry: pynmrstar.Entry) -> str:
+        """ Returns a digest of the contents of an entry. Values are digested as they read back from entry.str (None
+        as '.' and everything else as a string), so an entry digests the same before and after being written. """
+
+        def star_value(value) -> str:
+            return '.' if value is None else str(value)
+
+        digest = hashlib.blake2b(orjson.dumps(entry.entry_id, default=str), digest_size=16)
+        for saveframe in entry.frame_list:
+            digest.update(orjson.dumps([saveframe.name, saveframe.category, saveframe.tag_prefix,
+                                        [[tag[0], star_value(tag[1])] for tag in saveframe.tags]], default=str))
+            for loop in saveframe.loops:
+                digest.update(orjson.dumps([loop.category, loop.tags,
+                                            [[star_value(value) for value in row] for row in loop.data]],
+                                           default=str))
+        return digest.hexdigest()
+
+    def entry_unchanged(self, digest: str) -> bool:
+        """ Checks if an entry digest (from entry_digest()) matches the one recorded when the current entry was
+        written. This avoids loading the stored entry, but a False result only means that the entries must be compared
+        in full. """
+
+        return self.metadata.get('entry_blake2b') == digest
+
+    def write_entry(self, entry: pynmrstar.Entry, digest: Optional[str] = None) -> None:
+        """ Save an entry in the standard place. If the caller already has the entry_digest() of the entry, it can be
+        provided to avoid computing it again. """
 
         self.raise_write_errors()
-        self.write_file('entry.str', str(entry).encode(), root=True)
+
+        # Write one saveframe at a time (formatted the same way as str(entry)) so that the whole formatted entry is
+        #  never held in memory at once
+        with self._atomic_write(os.path.join(self._entry_dir, 'entry.str'), durable=True) as temp_path, \
+                open(temp_path, 'wb') as entry_file:
+            entry_file.write(("data_%s\n\n" % entry.entry_id).encode())
+            seen_categories: Set[str] = set()
+            for position, saveframe in enumerate(entry.frame_list):
+                if position:
+                    entry_file.write(b"\n")
+                entry_file.write(saveframe.format(skip_empty_loops=False,
+                                                  show_comments=saveframe.category not in seen_categories).encode())
+                seen_categories.add(saveframe.category)
+        self._dirty_paths.add('entry.str')
+        self.metadata['entry_blake2b'] = digest if digest is not None else self.entry_digest(entry)
+
+    @contextlib.contextmanager
+    def _atomic_write(self, full_path: str, durable: bool = False) -> Iterator[str]:
+        """ Yields the path of a temporary file to write to, which then replaces the file at full_path (with the
+        standard permissions). If writing fails, the existing file is left untouched. The replacement survives a
+        process crash either way, but only a durable write is synced to disk, and so also survives a power loss. """
+
+        temp_fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.join(self._entry_dir, '.git'))
+        os.close(temp_fd)
+        try:
+            yield temp_path
+            if durable:
+                self._fsync_path(temp_path)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, full_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        if durable:
+            # Sync the directory too, so that the rename itself is on disk
+            self._fsync_path(os.path.dirname(full_path))
+
+    @staticmethod
+    def _fsync_path(path: str) -> None:
+        """ Flushes a file or directory to disk. """
+
+        fd: int = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
     def get_file(self, path: str, root: bool = True) -> BinaryIO:
         """ Returns the current version of a file from the repo. """
 
-        secured_path, secured_filename = secure_full_path(path)
-        if not secured_filename:
-            raise RequestError('Cannot access directories, just files.')
+        if root:
+            # Files in the entry root are never in subdirectories, so only the name needs securing
+            full_path: str = os.path.join(self._entry_dir, secure_filename(os.path.basename(path)))
+        else:
+            secured_path, secured_filename = secure_full_path(path)
+            full_path = os.path.join(self._data_dir, secured_path, secured_filename)
         try:
-            if root:
-                return open(os.path.join(self._entry_dir, secured_filename), "rb")
-            else:
-                return open(os.path.join(self._entry_dir, 'data_files', secured_path, secured_filename), 'rb')
+            return open(full_path, 'rb')
         except IOError:
             raise RequestError('No file with that name saved for this entry.')
 
     def get_data_file_list(self) -> List[str]:
         """ Returns the list of data files associated with this deposition. """
 
-        return os.listdir(os.path.join(self._entry_dir, 'data_files'))
+        with os.scandir(self._data_dir) as data_dir:
+            return [dir_entry.name for dir_entry in data_dir]
 
     def delete_data_file(self, path: str) -> bool:
         """ Delete a data file by name."""
@@ -443,7 +542,7 @@ INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
         self.raise_write_errors()
 
         secured_path, secured_filename = secure_full_path(path)
-        data_file_path = os.path.join(self._entry_dir, 'data_files', secured_path, secured_filename)
+        data_file_path = os.path.join(self._data_dir, secured_path, secured_filename)
 
         try:
             if os.path.isfile(data_file_path):
@@ -454,7 +553,7 @@ INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
             return False
         except OSError:
             raise RequestError('You must first remove any files in a directory before removing the directory itself.')
-        self._modified_files = True
+        self._dirty_paths.add(os.path.join('data_files', secured_path, secured_filename))
         return True
 
     def raise_write_errors(self):
@@ -470,6 +569,7 @@ INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
     def write_file(self, filename: str,
                    data: Optional[bytes] = None,
                    source_path: Optional[str] = None,
+                   source_file: Optional[BinaryIO] = None,
                    root: bool = False) \
             -> str:
         """ Adds (or overwrites) a file to the repo. Returns the name of the written file. """
@@ -488,24 +588,30 @@ INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
         if root:
             full_path: str = os.path.join(self._entry_dir, file_name)
         else:
-            full_path = os.path.join(self._entry_dir, 'data_files', file_path, file_name)
+            full_path = os.path.join(self._data_dir, file_path, file_name)
 
         # Make the directory if it doesn't exist
         if not os.path.exists(os.path.dirname(full_path)):
             pathlib.Path(os.path.dirname(full_path)).mkdir(parents=True, exist_ok=True)
 
-        # Write the data, depending on how we got it
-        if data and not source_path:
-            with open(full_path, "wb") as fo:
-                fo.write(data)
-        elif source_path and not data:
-            shutil.copy(source_path, full_path)
-        else:
-            raise ValueError('Cannot provide both data and source_path, please only provide one.')
-        # Make sure the permissions of the written file are correct
-        os.chmod(full_path, 0o644)
+        # Write the data, depending on how we got it. Files in the entry root (the metadata and schema) are synced to
+        #  disk, as they are the only copy of the deposition's state until committed. Data files are left to the OS
+        #  so that large uploads stay fast.
+        with self._atomic_write(full_path, durable=root) as temp_path:
+            if data and not source_path and not source_file:
+                with open(temp_path, 'wb') as fo:
+                    fo.write(data)
+            elif source_path and not data and not source_file:
+                # copyfile lets the kernel do the copy (sendfile) where it can
+                shutil.copyfile(source_path, temp_path)
+            elif source_file and not data and not source_path:
+                # Copy in 1 MB chunks so that large uploads are never fully held in memory
+                with open(temp_path, 'wb') as fo:
+                    shutil.copyfileobj(source_file, fo, 1024 * 1024)
+            else:
+                raise ValueError('Must provide exactly one of data, source_path, or source_file.')
 
-        self._modified_files = True
+        self._dirty_paths.add(os.path.relpath(full_path, self._entry_dir))
 
         if root:
             return file_name
@@ -516,19 +622,37 @@ INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
         """ Commits the changes to the repository with a message. """
 
         # Check if the metadata has changed
-        if self._live_metadata != self._original_metadata:
-            self.write_file('submission_info.json',
-                            json.dumps(self._live_metadata, indent=2, sort_keys=True).encode(),
-                            root=True)
-            self._original_metadata = self._live_metadata.copy()
+        if self._live_metadata:
+            metadata_bytes: bytes = orjson.dumps(self._live_metadata, option=_METADATA_OPTIONS)
+            if metadata_bytes != self._original_metadata:
+                self.write_file('submission_info.json', metadata_bytes, root=True)
+                self._original_metadata = metadata_bytes
 
         # No recorded changes
-        if not self._modified_files:
+        if not self._dirty_paths:
             return False
 
-        # See if they wrote the same value to an existing file
-        if not self._repo.untracked_files and not [item.a_path for item in self._repo.index.diff(None)]:
-            return False
+        # Stage only the paths that were written or deleted, rather than having git scan the whole working tree. This
+        #  goes through the git CLI because GitPython's in-process IndexFile.add changes the process working directory.
+        written: List[str] = sorted(path for path in self._dirty_paths
+                                    if os.path.isfile(os.path.join(self._entry_dir, path)))
+        removed: List[str] = sorted(self._dirty_paths.difference(written))
+        # Large uploads are staged in batches to bound the size of each git invocation
+        for batch_start in range(0, len(written), _INDEX_BATCH_SIZE):
+            self._repo.git.add('--', *written[batch_start:batch_start + _INDEX_BATCH_SIZE])
+        for batch_start in range(0, len(removed), _INDEX_BATCH_SIZE):
+            self._repo.git.rm('-r', '--cached', '--ignore-unmatch', '--quiet', '--',
+                              *removed[batch_start:batch_start + _INDEX_BATCH_SIZE])
+        self._dirty_paths.clear()
+
+        # Build the tree once, both to compare it with HEAD and to commit it
+        tree: Tree = self._repo.index.write_tree()
+        parent_commits: List[Commit] = []
+        if self._repo.head.is_valid():
+            parent_commits.append(self._repo.head.commit)
+            # See if they wrote the same value to an existing file
+            if tree.binsha == parent_commits[0].tree.binsha:
+                return False
 
         # Store the IP of the user making the change
         try:
@@ -536,8 +660,6 @@ INSERT INTO logtable (logid,depnum,actdesc,newstatus,statuslevel,logdate,login)
         except RuntimeError:
             pass
 
-        # Add the changes, commit
-        self._repo.git.add(all=True)
-        self._repo.git.commit(message=message)
-        self._modified_files = False
+        # Write the commit object in-process rather than running 'git commit'. Deposition repos have no commit hooks.
+        Commit.create_from_tree(self._repo, tree, message, parent_commits=parent_commits, head=True)
         return True
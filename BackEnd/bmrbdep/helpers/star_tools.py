@@ -1,19 +1,41 @@
+import copy
 import re
+from collections import defaultdict
+from typing import Dict, List, Set
+
 import pynmrstar
 
+# Saveframe tags which are never copied from an existing entry into the template
+_SKIP_TAGS = frozenset({'sf_category', 'sf_framecode', 'id', 'entry_id', 'nmr_star_version',
+                        'original_nmr_star_version', 'atomic_coordinate_file_name', 'atomic_coordinate_file_syntax',
+                        'constraint_file_name'})
+# Loop categories which are never copied from an existing entry into the template (the experimental data loops)
+_SKIP_LOOP_CATEGORIES = frozenset({'_Upload_data'})
+_SPLIT_NUM = re.compile('([0-9]+)')
+
+
+def _alphanum_key(saveframe: pynmrstar.Saveframe) -> tuple:
+    """ Splits a saveframe name into its text and number parts, so that 'x_10' sorts after 'x_9'. """
+
+    return tuple(int(c) if c.isdigit() else c for c in _SPLIT_NUM.split(saveframe.name))
+
 
 def _sort_saveframes(sort_list: list) -> list:
     """ Sort the given iterable in the way that humans expect.
 
     Via: https://stackoverflow.com/questions/2669059/how-to-sort-alpha-numeric-set-in-python"""
 
-    def convert(text):
-        return int(text) if text.isdigit() else text
+    return sorted(sort_list, key=_alphanum_key)
+
 
-    def alphanum_key(key):
-        return [convert(c) for c in re.split('([0-9]+)', key.name)]
+def _saveframes_by_category(entry: pynmrstar.Entry) -> Dict[str, List[pynmrstar.Saveframe]]:
+    """ Groups the saveframes of an entry by category in a single pass, preserving their order. """
 
-    return sorted(sort_list, key=alphanum_key)
+    by_category: Dict[str, List[pynmrstar.Saveframe]] = defaultdict(list)
+    for saveframe in entry.frame_list:
+        if saveframe.category:
+            by_category[saveframe.category].append(saveframe)
+    return by_category
 
 
 def merge_entries(template_entry: pynmrstar.Entry, existing_entry: pynmrstar.Entry, new_schema: pynmrstar.Schema,
@@ -22,12 +44,16 @@ def merge_entries(template_entry: pynmrstar.Entry, existing_entry: pynmrstar.Ent
      preserve_entry_information boolean is available."""
 
     existing_entry.normalize()
+    existing_by_category = _saveframes_by_category(existing_entry)
+    template_by_category = _saveframes_by_category(template_entry)
 
     # Rename the saveframes in the uploaded entry before merging them
-    for category in existing_entry.category_list:
-        for x, saveframe in enumerate(_sort_saveframes(existing_entry.get_saveframes_by_category(category))):
+    for category, saveframes in existing_by_category.items():
+        # Saveframes of the same category share a tag prefix, so check for a "Name" tag once per category
+        category_has_name_tag = (saveframes[0].tag_prefix + '.name').lower() in new_schema.schema
+        for x, saveframe in enumerate(_sort_saveframes(saveframes)):
             # Set the "Name" tag if it isn't already set
-            if (saveframe.tag_prefix + '.name').lower() in new_schema.schema:
+            if category_has_name_tag:
                 try:
                     saveframe.add_tag('Name', saveframe['sf_framecode'][0].replace("_", " "), update=False)
                 except ValueError:
@@ -36,43 +62,51 @@ def merge_entries(template_entry: pynmrstar.Entry, existing_entry: pynmrstar.Ent
             if saveframe.name != new_name:
                 existing_entry.rename_saveframe(saveframe.name, new_name)
 
-    for category in existing_entry.category_list:
-        delete_saveframes = template_entry.get_saveframes_by_category(category)
-        for saveframe in delete_saveframes:
-            if saveframe.category == "entry_interview":
-                continue
-            del template_entry[saveframe]
-        for saveframe in existing_entry.get_saveframes_by_category(category):
+    # Remove the template saveframes that will be replaced in a single pass - deleting them one at a time looks each
+    #  one up with Saveframe.__eq__, which formats every saveframe it is compared against
+    replaced_saveframes = {id(saveframe) for category in existing_by_category
+                           for saveframe in template_by_category.get(category, [])
+                           if saveframe.category != "entry_interview"}
+    template_entry.frame_list = [_ for _ in template_entry.frame_list if id(_) not in replaced_saveframes]
+
+    saveframe_templates: Dict[str, pynmrstar.Saveframe] = {}
+    skipped_categories: Set[str] = set()
+    for category, saveframes in existing_by_category.items():
+        for saveframe in saveframes:
             # Don't copy over the entry interview at all
             if saveframe.category == "entry_interview":
                 continue
 
-            # If the saveframe isn't in the dictionary, or has some other issue, better to skip it
-            #  than to crash
-            try:
-                new_saveframe = pynmrstar.Saveframe.from_template(category, name=saveframe.name,
-                                                                  entry_id=template_entry.entry_id,
-                                                                  default_values=True, schema=new_schema, all_tags=True)
-            except ValueError:
+            # Building a saveframe from the schema is slow, so only do it once per category and copy it after that
+            if category in skipped_categories:
                 continue
+            if category not in saveframe_templates:
+                # If the saveframe isn't in the dictionary, or has some other issue, better to skip it
+                #  than to crash
+                try:
+                    saveframe_templates[category] = pynmrstar.Saveframe.from_template(
+                        category, name=saveframe.name, entry_id=template_entry.entry_id, default_values=True,
+                        schema=new_schema, all_tags=True)
+                except ValueError:
+                    skipped_categories.add(category)
+                    continue
+            new_saveframe = copy.deepcopy(saveframe_templates[category])
+            new_saveframe.name = saveframe.name
             frame_prefix_lower = saveframe.tag_prefix.lower()
 
             # Don't copy the tags from entry_information
             if saveframe.category != "entry_information" or preserve_entry_information:
                 for tag in saveframe.tags:
                     lower_tag = tag[0].lower()
-                    if lower_tag not in ['sf_category', 'sf_framecode', 'id', 'entry_id', 'nmr_star_version',
-                                         'original_nmr_star_version', 'atomic_coordinate_file_name',
-                                         'atomic_coordinate_file_syntax', 'constraint_file_name']:
-                        fqtn = frame_prefix_lower + '.' + lower_tag
+                    if lower_tag not in _SKIP_TAGS:
+                        fqtn = f"{frame_prefix_lower}.{lower_tag}"
                         if fqtn in new_schema.schema or lower_tag == '_deleted':
                             new_saveframe.add_tag(tag[0], tag[1], update=True)
 
             for loop in saveframe.loops:
-                # Don't copy the experimental data loops
-                if loop.category == "_Upload_data":
+                if loop.category in _SKIP_LOOP_CATEGORIES:
                     continue
-                lower_tags = [_.lower() for _ in loop.tags]
+                lower_tags = frozenset(_.lower() for _ in loop.tags)
 
                 try:
                     tags_to_pull = [_ for _ in new_saveframe[loop.category].tags if _.lower() in lower_tags]
@@ -87,16 +121,16 @@ def merge_entries(template_entry: pynmrstar.Entry, existing_entry: pynmrstar.Ent
             template_entry.add_saveframe(new_saveframe)
 
     # Strip off any loop Entry_ID tags from the original entry
+    entry_id_fks = frozenset(fqtn for fqtn, tag_schema in new_schema.schema.items()
+                             if tag_schema.get('Natural foreign key') == '_Entry.ID')
     for saveframe in template_entry.frame_list:
         for loop in saveframe:
-            for tag in loop.tags:
-                fqtn = (loop.category + "." + tag).lower()
-                try:
-                    tag_schema = new_schema.schema[fqtn]
-                    if tag_schema['Natural foreign key'] == '_Entry.ID':
-                        loop[tag] = [None] * len(loop[tag])
-                except KeyError:
-                    pass
+            category_lower = loop.category.lower() + "."
+            for position, tag in enumerate(loop.tags):
+                if category_lower + tag.lower() in entry_id_fks:
+                    # Blank the column in place; assigning through loop[tag] would build the whole column three times
+                    for row in loop.data:
+                        row[position] = None
 
 
 def create_entity_for_saveframe_and_attach(parent_entry: pynmrstar.Entry, saveframe: pynmrstar.Saveframe,